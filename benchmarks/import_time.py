@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+"""
+Measures the cost of importing pymotiva in a fresh interpreter.
+
+Usage: python benchmarks/import_time.py [runs]
+"""
+
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PROBE = 'import threading, pymotiva; print(threading.active_count())'
+
+
+def measure():
+  out = subprocess.run([sys.executable, '-X', 'importtime', '-c', PROBE],
+                       cwd=ROOT, capture_output=True, text=True, check=True)
+  # Lines look like: "import time:  self [us] | cumulative | package"
+  for line in out.stderr.splitlines():
+    fields = [f.strip() for f in line.split('|')]
+    if len(fields) == 3 and fields[2] == 'pymotiva':
+      return int(fields[1]), int(out.stdout.strip())
+  raise RuntimeError('pymotiva not found in -X importtime output')
+
+
+def main(runs=20):
+  samples = []
+  for _ in range(runs):
+    usec, threads = measure()
+    if threads != 1:
+      print('warning: importing pymotiva started %d extra thread(s)' % (threads - 1))
+    samples.append(usec)
+  print('pymotiva import: median %d us, min %d us, max %d us (%d runs)' % (
+      statistics.median(samples), min(samples), max(samples), runs))
+
+
+if __name__ == '__main__':
+  main(int(sys.argv[1]) if len(sys.argv) > 1 else 20)
@@ -29,29 +29,41 @@ SUPPORT_EMOTIVA = (
     | SUPPORT_SELECT_SOUND_MODE
 )
 
+SUPPORT_EMOTIVA_ZONE = SUPPORT_EMOTIVA & ~SUPPORT_SELECT_SOUND_MODE
+
 
 def setup_platform(hass, config, add_entities, discovery_info=None):
     """Set up the Emotiva platform."""
 
     from custom_components.emotiva.pymotiva import Emotiva
-    add_entities(EmotivaDevice(Emotiva(ip, info))
-                for ip, info in Emotiva.discover())
+    entities = []
+    for ip, info in Emotiva.discover():
+        emo = Emotiva(ip, info)
+        emo.connect()
+        # All zones share the device's connection, subscription and state.
+        entities.extend(EmotivaDevice(zone) for zone in emo.zones
+                        if zone.supported)
+    add_entities(entities)
 
         
 class EmotivaDevice(MediaPlayerEntity):
-    """Representation of an Emotiva device."""
+    """Representation of one zone of an Emotiva device."""
 
     def __init__(self, emo):
-        """Initialize the Emotiva Receiver."""
+        """Initialize the Emotiva Receiver zone."""
         self._emo = emo
-        self._emo.connect()
-        self._name = '%s %s' % (self._emo.name, self._emo.model)
+        device = self._emo.device
+        self._name = '%s %s' % (device.name, device.model)
+        if not self._emo.is_main:
+            self._name = '%s %s' % (self._name, self._emo.name)
         self._min_volume = -96.0
         self._max_volume = 11
         self._emo.set_update_cb(lambda: self.schedule_update_ha_state())
 
     def update(self):
-        self._emo.update()
+        # A single update refreshes every zone of the device.
+        if self._emo.is_main:
+            self._emo.update()
         return True
 
     @property
@@ -94,7 +106,9 @@ class EmotivaDevice(MediaPlayerEntity):
     @property
     def supported_features(self):
         """Flag media player features that are supported."""
-        return SUPPORT_EMOTIVA
+        if self._emo.is_main:
+            return SUPPORT_EMOTIVA
+        return SUPPORT_EMOTIVA_ZONE
 
     def turn_off(self):
         """Turn off media player."""
@@ -3,12 +3,16 @@
 __author__ = "Dima Zavin"
 __copyright__ = "Copyright 2016, Dima Zavin"
 
+import collections
 import logging
+import math
 from os import name
 import select
 import socket
+import struct
 import threading
-from lxml import etree
+import time
+from types import MappingProxyType
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -26,13 +30,621 @@ class InvalidSourceError(Error):
 class InvalidModeError(Error):
   pass
 
+class InvalidCaptureError(Error):
+  pass
+
+class StateTimeoutError(Error):
+  pass
+
+class InvalidFieldError(Error):
+  pass
+
+
+class LxmlBackend(object):
+  """
+  XML backend built on lxml. Malformed packets are parsed in recover mode.
+  """
+  def __init__(self):
+    from lxml import etree
+    self._etree = etree
+    self.ParseError = etree.ParseError
+    self.TreeBuilder = etree.TreeBuilder
+
+  def fromstring(self, data):
+    parser = self._etree.XMLParser(ns_clean=True, recover = True)
+    return self._etree.XML(data, parser)
+
+  def tostring(self, elem):
+    return self._etree.tostring(elem)
+
+
+class ElementTreeBackend(object):
+  """
+  XML backend built on the standard library's expat based ElementTree.
+
+  Unlike LxmlBackend it is strict: a malformed packet fails to parse as a
+  whole instead of being partially recovered.
+  """
+  def __init__(self):
+    from xml.etree import ElementTree
+    self._etree = ElementTree
+    self.ParseError = ElementTree.ParseError
+    self.TreeBuilder = ElementTree.TreeBuilder
+
+  def fromstring(self, data):
+    return self._etree.fromstring(data)
+
+  def tostring(self, elem):
+    return self._etree.tostring(elem)
+
+
+_xml_backend = None
+_xml_backend_lock = threading.Lock()
+
+def get_xml_backend():
+  """
+  Returns the XML backend, loading it on first use: lxml when it is
+  installed, the standard library otherwise.
+  """
+  global _xml_backend
+  if _xml_backend is None:
+    with _xml_backend_lock:
+      if _xml_backend is None:
+        try:
+          _xml_backend = LxmlBackend()
+        except ImportError:
+          _LOGGER.debug("lxml not available, using xml.etree")
+          _xml_backend = ElementTreeBackend()
+  return _xml_backend
+
+def set_xml_backend(backend):
+  """
+  Overrides the XML backend, e.g. set_xml_backend(ElementTreeBackend()).
+  """
+  global _xml_backend
+  with _xml_backend_lock:
+    _xml_backend = backend
+
+
+EmotivaRecord = collections.namedtuple('EmotivaRecord',
+                                       ['timestamp', 'direction', 'ip', 'port', 'data'])
+
+
+class EmotivaCapture(object):
+  """
+  Append-only recorder of raw datagrams exchanged with Emotiva devices.
+
+  Each record is a fixed-size binary header (timestamp, direction, device ip,
+  device port, payload length) followed by the payload itself. Timestamps are
+  monotonic seconds since the capture session started. Every session opens
+  with a SESSION record whose payload is the wall clock start time, so
+  appending to an existing capture keeps its timing intact.
+  """
+  MAGIC = b'EMOCAP2\n'
+  INBOUND = 'I'
+  OUTBOUND = 'O'
+  SESSION = 'S'
+  _HEADER = struct.Struct('<dc4sHI')
+
+  def __init__(self, path):
+    self._path = path
+    self._lock = threading.Lock()
+    self._file = open(path, 'ab')
+    if self._file.tell() == 0:
+      self._file.write(self.MAGIC)
+    else:
+      with open(path, 'rb') as f:
+        magic = f.read(len(self.MAGIC))
+      if magic != self.MAGIC:
+        self._file.close()
+        self._file = None
+        raise InvalidCaptureError('%s is not an Emotiva capture' % path)
+    self._start = time.monotonic()
+    self.record(self.SESSION, '0.0.0.0', 0, repr(time.time()).encode('ascii'))
+
+  def record(self, direction, ip, port, data):
+    hdr = self._HEADER.pack(time.monotonic() - self._start,
+                            direction.encode('ascii'),
+                            socket.inet_aton(ip), port, len(data))
+    with self._lock:
+      if self._file is None:
+        return
+      self._file.write(hdr + data)
+
+  def flush(self):
+    with self._lock:
+      if self._file is not None:
+        self._file.flush()
+
+  def close(self):
+    with self._lock:
+      if self._file is not None:
+        self._file.close()
+        self._file = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+
+class EmotivaReplay(object):
+  """
+  Reads back a file written by EmotivaCapture and feeds it to a handler.
+  """
+
+  def __init__(self, path):
+    self._path = path
+
+  def __iter__(self):
+    hdr = EmotivaCapture._HEADER
+    with open(self._path, 'rb') as f:
+      if f.read(len(EmotivaCapture.MAGIC)) != EmotivaCapture.MAGIC:
+        raise InvalidCaptureError('%s is not an Emotiva capture' % self._path)
+      while True:
+        raw = f.read(hdr.size)
+        if not raw:
+          break
+        if len(raw) != hdr.size:
+          _LOGGER.warning('Truncated record header in %s' % self._path)
+          break
+        ts, direction, ip, port, size = hdr.unpack(raw)
+        data = f.read(size)
+        if len(data) != size:
+          _LOGGER.warning('Truncated record payload in %s' % self._path)
+          break
+        yield EmotivaRecord(ts, direction.decode('ascii'),
+                            socket.inet_ntoa(ip), port, data)
+
+  def replay(self, handler, speed=1.0, ip=None,
+             direction=EmotivaCapture.INBOUND):
+    """
+    Calls handler(data) for every matching record and returns the number of
+    records replayed.
+
+    speed scales the original inter-record delays: 1.0 is real time, 2.0 is
+    twice as fast, and None (or 0) replays as fast as possible. Only records
+    travelling in the given direction (and from the given ip, if any) are
+    replayed. The gap between capture sessions is not replayed.
+    """
+    count = 0
+    first_ts = None
+    for rec in self:
+      if rec.direction == EmotivaCapture.SESSION:
+        first_ts = None
+        continue
+      if direction is not None and rec.direction != direction:
+        continue
+      if ip is not None and rec.ip != ip:
+        continue
+      if speed:
+        if first_ts is None:
+          first_ts = rec.timestamp
+          start = time.monotonic()
+        delay = (rec.timestamp - first_ts) / speed - (time.monotonic() - start)
+        if delay > 0:
+          time.sleep(delay)
+      handler(rec.data)
+      count += 1
+    return count
+
+
+def _elem_tag(elem):
+  # Protocol 3.0 reports <property name="volume" .../> instead of <volume .../>
+  if elem.tag == 'property':
+    return elem.get('name')
+  return elem.tag
+
+
+def _parse_volume(val):
+  if val != None:
+    return float(val.replace(" ", ""))
+  return None
+
+
+class EmotivaState(collections.namedtuple('EmotivaState',
+                                          ['values', 'source_map', 'mode_map',
+                                           'muted', 'zone2_muted'])):
+  """
+  Immutable snapshot of a device's state.
+
+  values maps notify tags to their raw string values, source_map maps source
+  names to input numbers and mode_map maps mode names to
+  (command, notify tag, visible) tuples. A new snapshot is published after
+  every status update, so all fields of one snapshot are consistent.
+  """
+  __slots__ = ()
+  # Fields derived from the raw values, reported under these names by get()
+  # and changes() in place of their underlying notify tags.
+  FIELDS = ('power', 'volume', 'mute', 'source', 'sources', 'mode', 'modes',
+            'zone2_power', 'zone2_volume', 'zone2_mute', 'zone2_source')
+
+  def get(self, field):
+    if field in self.FIELDS:
+      return getattr(self, field)
+    return self.values.get(field)
+
+  def changes(self, old):
+    """
+    Returns a list of (field, old value, new value) for every field that
+    differs between the old snapshot and this one.
+    """
+    fields = self.FIELDS + tuple(tag for tag in self.values
+                                 if tag not in self.FIELDS and tag != 'zone2_input'
+                                 and not tag.startswith(('input_', 'mode_')))
+    changed = []
+    for field in fields:
+      before, after = old.get(field), self.get(field)
+      if before != after:
+        changed.append((field, before, after))
+    return changed
+
+  @property
+  def power(self):
+    return self.values.get('power') == 'On'
+
+  @property
+  def volume(self):
+    return _parse_volume(self.values.get('volume'))
+
+  @property
+  def mute(self):
+    return self.muted
+
+  @property
+  def source(self):
+    return self.values.get('source')
+
+  @property
+  def sources(self):
+    return tuple(self.source_map.keys())
+
+  @property
+  def mode(self):
+    return self.values.get('mode')
+
+  @property
+  def modes(self):
+    #we return only the modes that are active
+    return tuple(name for name, m in self.mode_map.items() if m[2])
+
+  @property
+  def zone2_power(self):
+    return self.values.get('zone2_power') == 'On'
+
+  @property
+  def zone2_volume(self):
+    return _parse_volume(self.values.get('zone2_volume'))
+
+  @property
+  def zone2_mute(self):
+    return self.zone2_muted
+
+  @property
+  def zone2_source(self):
+    return self.values.get('zone2_input')
+
+
+EmotivaEvent = collections.namedtuple('EmotivaEvent',
+                                      ['timestamp', 'field', 'old', 'new'])
+
+
+class EmotivaSubscription(object):
+  """
+  Blocking, iterable queue of EmotivaEvents for one subscriber.
+
+  The queue holds at most maxsize events. When the subscriber falls behind,
+  the oldest events are dropped (and counted in dropped) so that the
+  publisher never blocks.
+  """
+
+  def __init__(self, stream, maxsize):
+    self._stream = stream
+    self._queue = collections.deque(maxlen=maxsize)
+    self._cond = threading.Condition()
+    self._closed = False
+    self.dropped = 0
+
+  def _put(self, event):
+    with self._cond:
+      if len(self._queue) == self._queue.maxlen:
+        self.dropped += 1
+      self._queue.append(event)
+      self._cond.notify()
+
+  def get(self, timeout=None):
+    """
+    Returns the next event, or None if timeout expires or the subscription
+    is closed.
+    """
+    with self._cond:
+      if not self._cond.wait_for(lambda: self._queue or self._closed, timeout):
+        return None
+      if self._queue:
+        return self._queue.popleft()
+      return None
+
+  def close(self):
+    self._stream.unsubscribe(self)
+    with self._cond:
+      self._closed = True
+      self._cond.notify_all()
+
+  def __iter__(self):
+    while True:
+      event = self.get()
+      if event is None:
+        return
+      yield event
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+
+class EmotivaAsyncSubscription(object):
+  """
+  asyncio flavour of EmotivaSubscription, used with "async for". It must be
+  created from the event loop that consumes it.
+  """
+  _CLOSED = object()
+
+  def __init__(self, stream, maxsize):
+    import asyncio
+    self._stream = stream
+    self._loop = asyncio.get_running_loop()
+    self._queue = asyncio.Queue(maxsize)
+    self._closed = False
+    self.dropped = 0
+
+  def _put(self, event):
+    try:
+      self._loop.call_soon_threadsafe(self._put_nowait, event)
+    except RuntimeError:
+      # the loop is closed, nobody is listening anymore
+      self._stream.unsubscribe(self)
+
+  def _put_nowait(self, event):
+    if self._queue.full():
+      self._queue.get_nowait()
+      self.dropped += 1
+    self._queue.put_nowait(event)
+
+  async def get(self):
+    """
+    Returns the next event, or None once the subscription is closed.
+    """
+    if self._closed:
+      return None
+    event = await self._queue.get()
+    if event is self._CLOSED:
+      self._closed = True
+      return None
+    return event
+
+  def close(self):
+    self._stream.unsubscribe(self)
+    try:
+      self._loop.call_soon_threadsafe(self._close)
+    except RuntimeError:
+      pass
+
+  def _close(self):
+    self._put_nowait(self._CLOSED)
+
+  def __aiter__(self):
+    return self
+
+  async def __anext__(self):
+    event = await self.get()
+    if event is None:
+      raise StopAsyncIteration
+    return event
+
+  async def __aenter__(self):
+    return self
+
+  async def __aexit__(self, *exc):
+    self.close()
+
+
+class EmotivaEventStream(object):
+  """
+  Fans out EmotivaEvents to any number of subscribers and keeps the last
+  `history` events for subscribers that join late.
+  """
+
+  def __init__(self, history):
+    self._history = collections.deque(maxlen=history)
+    self._subscribers = ()
+    self._lock = threading.Lock()
+
+  def publish(self, events):
+    with self._lock:
+      self._history.extend(events)
+      subscribers = self._subscribers
+    for sub in subscribers:
+      for event in events:
+        sub._put(event)
+
+  def history(self):
+    with self._lock:
+      return tuple(self._history)
+
+  def subscribe(self, sub, replay=False):
+    with self._lock:
+      if replay:
+        for event in self._history:
+          sub._put(event)
+      self._subscribers = self._subscribers + (sub,)
+    return sub
+
+  def unsubscribe(self, sub):
+    with self._lock:
+      self._subscribers = tuple(s for s in self._subscribers if s is not sub)
+
+
+EmotivaCapabilities = collections.namedtuple('EmotivaCapabilities',
+                                             ['protocol', 'rejected_tags',
+                                              'volume_noop', 'max_datagram'])
+
+
+class EmotivaZone(object):
+  """
+  View of one zone of an Emotiva device.
+
+  All zones of a device share its control socket, notify subscription and
+  state, so controlling several zones costs no extra network or parsing
+  work. Obtain zones through Emotiva.main and Emotiva.zone2.
+
+  Zone 2 maps onto the protocol as follows:
+    power   notify zone2_power,  commands zone2_power_on / zone2_power_off
+    volume  notify zone2_volume, commands zone2_set_volume / zone2_volume
+    mute    zone2_volume reads 'Mute' (as volume does for the main zone),
+            commands zone2_mute_on / zone2_mute_off
+    source  notify zone2_input,  commands zone2_input1 .. zone2_input8
+  """
+
+  def __init__(self, emo, name, prefix):
+    self._emo = emo
+    self._name = name
+    self._prefix = prefix
+    self._update_cb = None
+
+  # Fields every zone has. Those of Zone 2 carry the zone2_ prefix in
+  # EmotivaState.
+  ZONE_FIELDS = ('power', 'volume', 'mute', 'source')
+
+  def _owns(self, field):
+    if field == 'sources':
+      return True
+    return field.startswith('zone2_') == (self._prefix == 'zone2_')
+
+  def _field(self, field):
+    # Maps a field name of this zone to its EmotivaState name.
+    name = field
+    if field in self.ZONE_FIELDS:
+      name = self._prefix + field
+    if not self._owns(name):
+      raise InvalidFieldError('%s has no field "%s"' % (self._name, field))
+    return name
+
+  @property
+  def device(self):
+    return self._emo
+
+  @property
+  def name(self):
+    return self._name
+
+  @property
+  def is_main(self):
+    return self._prefix == ''
+
+  @property
+  def supported(self):
+    """
+    False if the device rejected this zone's power notifications, i.e. it
+    has no such zone. Only meaningful once the device is connected.
+    """
+    if self.is_main:
+      return True
+    return self._prefix + 'power' not in self._emo.capabilities.rejected_tags
+
+  def set_update_cb(self, cb):
+    """
+    Sets a zero-argument callback, called when state of this zone changes.
+    """
+    self._update_cb = cb
+
+  def update(self):
+    self._emo.update()
+
+  def snapshot(self):
+    return self._emo.snapshot()
+
+  def wait_for(self, field, value, timeout=None):
+    return self._emo.wait_for(self._field(field), value, timeout)
+
+  async def async_wait_for(self, field, value, timeout=None):
+    return await self._emo.async_wait_for(self._field(field), value, timeout)
+
+  @property
+  def power(self):
+    return self._emo.snapshot().get(self._field('power'))
+
+  @power.setter
+  def power(self, onoff):
+    self._emo._set_power(onoff, self._prefix)
+
+  @property
+  def volume(self):
+    return self._emo.snapshot().get(self._field('volume'))
+
+  @volume.setter
+  def volume(self, value):
+    if self.is_main:
+      self._emo.cancel_volume_ramp()
+    self._emo._set_volume(value, self._prefix)
+
+  def volume_up(self):
+    self._emo._volume_step(1, self._prefix)
+
+  def volume_down(self):
+    self._emo._volume_step(-1, self._prefix)
+
+  @property
+  def mute(self):
+    return self._emo.snapshot().get(self._field('mute'))
+
+  @mute.setter
+  def mute(self, enable):
+    self._emo._set_mute(enable, self._prefix)
+
+  @property
+  def sources(self):
+    return self._emo.sources
+
+  @property
+  def source(self):
+    return self._emo.snapshot().get(self._field('source'))
+
+  @source.setter
+  def source(self, val):
+    self._emo._set_source(val, self._prefix)
+
+  @property
+  def modes(self):
+    # sound modes only apply to the main zone
+    return self._emo.modes if self.is_main else ()
+
+  @property
+  def mode(self):
+    return self._emo.mode if self.is_main else None
+
+  @mode.setter
+  def mode(self, val):
+    if not self.is_main:
+      raise InvalidModeError('%s has no sound modes' % self._name)
+    self._emo.mode = val
+
+
 class EmotivaNotifier(threading.Thread):
+  # Receive buffer size for devices whose largest datagram isn't known yet.
+  DEFAULT_BUFSIZE = 65535
+
   def __init__(self):
     threading.Thread.__init__(self)
 
     self._devs = {}
     self._socks_by_port = {}
     self._socks_by_fileno = {}
+    self._captures = {}
+    self._bufsizes = {}
+    self._bufsize = self.DEFAULT_BUFSIZE
     self._lock = threading.Lock()
     self.setDaemon(True)
     self.start()
@@ -47,6 +659,22 @@ class EmotivaNotifier(threading.Thread):
         self._socks_by_fileno[sock.fileno()] = sock
       if ip not in self._devs:
         self._devs[ip] = callback
+        self._bufsizes[ip] = self.DEFAULT_BUFSIZE
+        self._bufsize = max(self._bufsizes.values())
+
+  def set_max_datagram(self, ip, size):
+    # The sockets are shared, so the buffer must fit the largest datagram of
+    # any registered device.
+    with self._lock:
+      self._bufsizes[ip] = size
+      self._bufsize = max(self._bufsizes.values())
+
+  def set_capture(self, ip, capture):
+    with self._lock:
+      if capture is None:
+        self._captures.pop(ip, None)
+      else:
+        self._captures[ip] = capture
 
   def run(self):
     _LOGGER.debug("Connected")
@@ -57,10 +685,13 @@ class EmotivaNotifier(threading.Thread):
       for s in readable:
         with self._lock:
           sock = self._socks_by_fileno[s]
-        data, (ip, port) = sock.recvfrom(4096)
+        data, (ip, port) = sock.recvfrom(self._bufsize)
         _LOGGER.debug("Got data %s from %s:%d" % (data, ip, port))
         with self._lock:
           cb = self._devs[ip]
+          capture = self._captures.get(ip)
+        if capture is not None:
+          capture.record(EmotivaCapture.INBOUND, ip, port, data)
         cb(data)
 
 class Emotiva(object):
@@ -69,9 +700,31 @@ class Emotiva(object):
   DISCOVER_RESP_PORT = 7001
   NOTIFY_EVENTS = set([
       'power', 'zone2_power', 'source', 'mode', 'volume', 'audio_input',
-      'audio_bitstream', 'video_input', 'video_format',
+      'audio_bitstream', 'video_input', 'video_format', 'zone2_volume',
+      'zone2_input',
   ]).union(set(['input_%d' % d for d in range(1, 9)]))
-  __notifier = EmotivaNotifier()
+  MIN_VOLUME = -96.0
+  MAX_VOLUME = 11.0
+  # Default ramp speed in dB per second, and size of each ramp step in dB.
+  VOLUME_RAMP_RATE = 10.0
+  VOLUME_RAMP_STEP = 1.0
+  # Number of past events kept for late subscribers, and default size of
+  # each subscriber's queue.
+  EVENT_HISTORY = 256
+  EVENT_QUEUE_SIZE = 256
+  # Receive buffer size: PROBE_DATAGRAM until replies of a device have been
+  # seen, then the largest datagram seen but at least MAX_DATAGRAM.
+  MAX_DATAGRAM = 4096
+  PROBE_DATAGRAM = 65535
+  # How long to wait for the volume notify when probing the volume noop.
+  VOLUME_PROBE_TIMEOUT = 1.0
+  # Command selecting input N, by zone prefix.
+  SOURCE_COMMANDS = {'': 'source_%d', 'zone2_': 'zone2_input%d'}
+  __notifier = None
+  __notifier_lock = threading.Lock()
+  # Capabilities learned so far, by (model, protocol version).
+  __capabilities = {}
+  __capabilities_lock = threading.Lock()
 
   def __init__(self, ip, transp_xml, events = NOTIFY_EVENTS):
     self._ip = ip
@@ -84,54 +737,176 @@ class Emotiva(object):
     self._setup_port_tcp = None
     self._ctrl_sock = None
     self._update_cb = None
-    self._modes = {"Stereo" :           ['stereo', 'mode_stereo', True],
-                  "Direct":             ['direct', 'mode_direct', True],
-                  "Dolby Surround":     ['dolby', 'mode_dolby', True],
-                  "DTS":                ['dts', 'mode_dts', True], 
-                  "All Stereo" :        ['all_stereo', 'mode_all_stereo', True],
-                  "Auto":               ['auto', 'mode_auto', True],
-                  "Reference Stereo" :  ['reference_stereo', 'mode_ref_stereo',True],
-                  "Surround":           ['surround_mode', 'mode_surround', True]}
+    self._capture = None
+    modes = {"Stereo" :           ('stereo', 'mode_stereo', True),
+             "Direct":             ('direct', 'mode_direct', True),
+             "Dolby Surround":     ('dolby', 'mode_dolby', True),
+             "DTS":                ('dts', 'mode_dts', True), 
+             "All Stereo" :        ('all_stereo', 'mode_all_stereo', True),
+             "Auto":               ('auto', 'mode_auto', True),
+             "Reference Stereo" :  ('reference_stereo', 'mode_ref_stereo',True),
+             "Surround":           ('surround_mode', 'mode_surround', True)}
     self._events = events
 
-    # current state
-    self._current_state = dict(((ev, None) for ev in self._events))
-    self._current_state.update(dict(((m[1], None) for m in self._modes.values())))
-    self._sources = {}
-    self._muted = False
+    # current state. Readers only ever see complete snapshots: _handle_status
+    # builds a new EmotivaState and publishes it with a single assignment.
+    # _state_lock only serializes writers (notifier thread vs. ack drain).
+    values = dict(((ev, None) for ev in self._events))
+    values.update(dict(((m[1], None) for m in modes.values())))
+    self._state = EmotivaState(MappingProxyType(values), MappingProxyType({}),
+                               MappingProxyType(modes), False, False)
+    self._state_lock = threading.Lock()
+    self._event_stream = EmotivaEventStream(self.EVENT_HISTORY)
+    self._waiters = ()
+    self._zones = (EmotivaZone(self, 'Main', ''),
+                   EmotivaZone(self, 'Zone 2', 'zone2_'))
+
+    self._ramp_lock = threading.Lock()
+    self._ramp_cancel = None
+    self._ramp_level = None
 
     self.__parse_transponder(transp_xml)
     if not self._ctrl_port or not self._notify_port:
       raise InvalidTransponderResponseError("Coulnd't find ctrl/notify ports")
 
+  @classmethod
+  def _notifier(cls):
+    # The notifier thread is shared by all devices and only started once the
+    # first device connects, so importing this module stays cheap.
+    with Emotiva.__notifier_lock:
+      if Emotiva.__notifier is None:
+        Emotiva.__notifier = EmotivaNotifier()
+      return Emotiva.__notifier
+
   def connect(self):
     self._ctrl_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     self._ctrl_sock.bind(('', self._ctrl_port))
     self._ctrl_sock.settimeout(0.5)
-    self.__notifier.register(self._ip, self._notify_port, self._notify_handler)
+    notifier = self._notifier()
+    if self._capture is not None:
+      notifier.set_capture(self._ip, self._capture)
+    notifier.register(self._ip, self._notify_port, self._notify_handler)
     self._subscribe_events(self._events)
+    notifier.set_max_datagram(self._ip, self.capabilities.max_datagram)
+
+  def set_capture(self, capture):
+    """
+    Records all control and notify traffic of this device to capture (an
+    EmotivaCapture instance). Pass None to stop recording.
+    """
+    self._capture = capture
+    if self._ctrl_sock is not None:
+      self._notifier().set_capture(self._ip, capture)
 
   def _send_request(self, req, ack=False):
+    """
+    Sends req and, if ack is set, processes responses until none arrives for
+    0.5s. Returns the list of (raw datagram, parsed response) acks received.
+    """
+    capture = self._capture
+    if capture is not None:
+      capture.record(EmotivaCapture.OUTBOUND, self._ip, self._ctrl_port, req)
     self._ctrl_sock.sendto(req, (self._ip, self._ctrl_port))
 
+    bufsize = self.capabilities.max_datagram
+    acks = []
     while ack:
       try:
-        _resp_data, (ip, port) = self._ctrl_sock.recvfrom(4096)
+        _resp_data, (ip, port) = self._ctrl_sock.recvfrom(bufsize)
         _LOGGER.debug(_resp_data)
+        if capture is not None:
+          capture.record(EmotivaCapture.INBOUND, ip, port, _resp_data)
         resp = self._parse_response(_resp_data)
+        if resp is None:
+          continue
         self._handle_status(resp)
+        acks.append((_resp_data, resp))
       except socket.timeout:
         break
+    return acks
 
   def _notify_handler(self, data):
+    if len(data) >= self.capabilities.max_datagram:
+      # the datagram may have been truncated, make room for larger ones
+      size = min(self.PROBE_DATAGRAM, 2 * len(data))
+      self._update_capabilities(lambda caps: caps._replace(
+          max_datagram=max(caps.max_datagram, size)))
     resp = self._parse_response(data)
-    self._handle_status(resp)
+    if resp is not None:
+      self._handle_status(resp)
 
   def _subscribe_events(self, events):
     msg = self.format_request('emotivaSubscription',
-                              [(ev, {}) for ev in events],
-                              {'protocol':"3.0"} if self._proto_ver == 3 else {})
-    self._send_request(msg, ack=True)
+                              [(ev, {}) for ev in self._supported(events)],
+                              self._protocol_attrs())
+    self._learn_capabilities(self._send_request(msg, ack=True))
+
+  def _capabilities_key(self):
+    # Transponders don't report the firmware version, so capabilities are
+    # shared by the devices of a model speaking the same protocol version.
+    # invalidate_capabilities() forgets them, e.g. after a firmware upgrade.
+    return (self._model, self._proto_ver)
+
+  @property
+  def capabilities(self):
+    """
+    The device's EmotivaCapabilities. They start out as conservative defaults
+    derived from the transponder and are refined from the device's replies.
+    volume_noop is None until probed by the first main zone volume step.
+    """
+    caps = Emotiva.__capabilities.get(self._capabilities_key())
+    if caps is None:
+      caps = self._default_capabilities()
+    return caps
+
+  def _default_capabilities(self):
+    return EmotivaCapabilities(self._proto_ver or 2.0, frozenset(), None,
+                               self.PROBE_DATAGRAM)
+
+  def _update_capabilities(self, update):
+    # update(caps) returns the new capabilities of this device's kind.
+    key = self._capabilities_key()
+    with Emotiva.__capabilities_lock:
+      caps = Emotiva.__capabilities.get(key)
+      if caps is None:
+        caps = self._default_capabilities()._replace(max_datagram=self.MAX_DATAGRAM)
+      learned = update(caps)
+      if learned != Emotiva.__capabilities.get(key):
+        _LOGGER.debug("Capabilities of %s: %s" % (self._ip, learned))
+        Emotiva.__capabilities[key] = learned
+    if self._ctrl_sock is not None:
+      self._notifier().set_max_datagram(self._ip, learned.max_datagram)
+
+  def _learn_capabilities(self, acks):
+    # Replies are UDP and may be lost or cut short by standby, so a tag
+    # missing from them says nothing. Only tags the device explicitly
+    # rejects are dropped, and what was learned is merged, never replaced.
+    if not acks:
+      return
+    rejected = frozenset(_elem_tag(elem) for _, resp in acks for elem in resp
+                         if elem.get('status') == 'nak')
+    largest = max(len(data) for data, _ in acks)
+    self._update_capabilities(lambda caps: caps._replace(
+        rejected_tags=caps.rejected_tags | rejected,
+        max_datagram=max(caps.max_datagram, largest)))
+
+  @classmethod
+  def invalidate_capabilities(cls, model=None):
+    """
+    Forgets the learned capabilities of all devices, or only of the given
+    model, e.g. after a firmware upgrade.
+    """
+    with Emotiva.__capabilities_lock:
+      for key in list(Emotiva.__capabilities):
+        if model is None or key[0] == model:
+          del Emotiva.__capabilities[key]
+
+  def _protocol_attrs(self):
+    return {'protocol': "3.0"} if self.capabilities.protocol >= 3 else {}
+
+  def _supported(self, events):
+    rejected = self.capabilities.rejected_tags
+    return [ev for ev in events if ev not in rejected]
 
   def __parse_transponder(self, transp_xml):
     elem = transp_xml.find('name')
@@ -141,7 +916,11 @@ class Emotiva(object):
 
     ctrl = transp_xml.find('control')
     elem = ctrl.find('version')
-    if elem is not None: self._proto_ver = elem.text
+    if elem is not None:
+      try:
+        self._proto_ver = float(elem.text)
+      except ValueError:
+        _LOGGER.warning("Unknown protocol version '%s'" % elem.text)
     elem = ctrl.find('controlPort')
     if elem is not None: self._ctrl_port = int(elem.text)
     elem = ctrl.find('notifyPort')
@@ -152,42 +931,177 @@ class Emotiva(object):
     if elem is not None: self._setup_port_tcp = int(elem.text)
 
   def _handle_status(self, resp):
-    for elem in resp:
-      if elem.tag not in self._current_state:
-        _LOGGER.debug('Unknown element: %s' % elem.tag)
-        continue
-      val = (elem.get('value') or '').strip()
-      visible = (elem.get('visible') or '').strip()
-      #update mode status
-      if (elem.tag.startswith('mode_') and visible != "true"):
-        _LOGGER.debug(' %s is no longer visible' % elem.tag)
-        for v in self._modes.items():
-          if(v[1][1] == elem.tag):
-            v[1][2] = False
-            self._modes.update({v[0]: v[1]})
-      #do not 
-      if (elem.tag.startswith('input_') and visible != "true"):
-        continue
-      if elem.tag == 'volume':
-        if val == 'Mute':
-          self._muted = True
+    with self._state_lock:
+      state = self._state
+      values = dict(state.values)
+      sources = dict(state.source_map)
+      modes = dict(state.mode_map)
+      muted = {'volume': state.muted, 'zone2_volume': state.zone2_muted}
+      for elem in resp:
+        tag = _elem_tag(elem)
+        if tag not in values:
+          _LOGGER.debug('Unknown element: %s' % tag)
           continue
-        self._muted = False
-        # fall through
-      if val:
-        self._current_state[elem.tag] = val
-        _LOGGER.debug("Updated '%s' <- '%s'" % (elem.tag, val))
-      if elem.tag.startswith('input_'):
-        num = elem.tag[6:]
-        self._sources[val] = int(num)
+        val = (elem.get('value') or '').strip()
+        visible = (elem.get('visible') or '').strip()
+        #update mode status
+        if (tag.startswith('mode_') and visible != "true"):
+          _LOGGER.debug(' %s is no longer visible' % tag)
+          for name, m in modes.items():
+            if(m[1] == tag):
+              modes[name] = (m[0], m[1], False)
+        #do not 
+        if (tag.startswith('input_') and visible != "true"):
+          continue
+        if tag in muted:
+          if val == 'Mute':
+            muted[tag] = True
+            continue
+          muted[tag] = False
+          # fall through
+        if val:
+          values[tag] = val
+          _LOGGER.debug("Updated '%s' <- '%s'" % (tag, val))
+        if tag.startswith('input_'):
+          num = tag[6:]
+          sources[val] = int(num)
+      self._state = EmotivaState(MappingProxyType(values),
+                                 MappingProxyType(sources),
+                                 MappingProxyType(modes), muted['volume'],
+                                 muted['zone2_volume'])
+      now = time.time()
+      events = [EmotivaEvent(now, field, old, new)
+                for field, old, new in self._state.changes(state)]
+      if events:
+        self._event_stream.publish(events)
+      state = self._state
+    # Raw tags such as mode_* or input_* don't produce events, so waiters are
+    # checked after every update. Predicates may talk to the device, so they
+    # run outside the state lock.
+    if self._waiters:
+      self._wake_waiters(state)
     if self._update_cb:
       self._update_cb()
+    for zone in self._zones:
+      if zone._update_cb and any(zone._owns(ev.field) for ev in events):
+        zone._update_cb()
+
+  def snapshot(self):
+    """
+    Returns the current EmotivaState. The snapshot never changes, so fields
+    read from it are consistent with each other.
+    """
+    return self._state
 
   def set_update_cb(self, cb):
     self._update_cb = cb
 
+  def events(self, replay=False, maxsize=EVENT_QUEUE_SIZE):
+    """
+    Subscribes to state change events. Returns an EmotivaSubscription that
+    yields EmotivaEvents when iterated, until it is closed. With replay, the
+    recent event history is delivered first.
+    """
+    return self._event_stream.subscribe(
+        EmotivaSubscription(self._event_stream, maxsize), replay)
+
+  def async_events(self, replay=False, maxsize=EVENT_QUEUE_SIZE):
+    """
+    Same as events(), but returns an async iterator. Must be called from the
+    event loop that consumes the events.
+    """
+    return self._event_stream.subscribe(
+        EmotivaAsyncSubscription(self._event_stream, maxsize), replay)
+
+  def event_history(self):
+    return self._event_stream.history()
+
+  @staticmethod
+  def _matches(field, match, val):
+    # A failing predicate (e.g. comparing a None value) counts as no match.
+    try:
+      return match(val)
+    except Exception as e:
+      _LOGGER.debug("wait_for predicate failed for '%s': %r" % (field, e))
+      return False
+
+  def _add_waiter(self, field, value, wake):
+    # The waiter is registered and the current state read under the state
+    # lock, so every later update is checked by _wake_waiters. The predicate
+    # itself runs without the lock. Returns the waiter, which the caller
+    # removes if it gives up.
+    match = value if callable(value) else (lambda v: v == value)
+    waiter = (field, match, wake)
+    with self._state_lock:
+      self._waiters = self._waiters + (waiter,)
+      state = self._state
+    self._check_waiter(waiter, state)
+    return waiter
+
+  def _remove_waiter(self, waiter):
+    # Returns True if the waiter was still registered. Whoever removes it
+    # first gets to wake it, so it is woken at most once.
+    with self._state_lock:
+      waiters = self._waiters
+      self._waiters = tuple(w for w in waiters if w is not waiter)
+      return len(self._waiters) != len(waiters)
+
+  def _check_waiter(self, waiter, state):
+    field, match, wake = waiter
+    val = state.get(field)
+    if self._matches(field, match, val) and self._remove_waiter(waiter):
+      wake(val)
+
+  def _wake_waiters(self, state):
+    for waiter in self._waiters:
+      self._check_waiter(waiter, state)
+
+  def wait_for(self, field, value, timeout=None):
+    """
+    Blocks until field (a name accepted by EmotivaState.get, e.g. 'power' or
+    'source') equals value, or until value(field value) returns True if value
+    is callable. The predicate receives None while the field is still unknown;
+    if it raises, that counts as no match. Returns the matching field value,
+    or raises StateTimeoutError after timeout seconds. Returns immediately if
+    the current state already matches.
+    """
+    done = threading.Event()
+    result = []
+    def wake(val):
+      result.append(val)
+      done.set()
+    waiter = self._add_waiter(field, value, wake)
+    if not done.wait(timeout):
+      self._remove_waiter(waiter)
+    if not result:
+      raise StateTimeoutError("Timed out waiting for '%s'" % field)
+    return result[0]
+
+  async def async_wait_for(self, field, value, timeout=None):
+    """
+    Coroutine version of wait_for().
+    """
+    import asyncio
+    loop = asyncio.get_running_loop()
+    fut = loop.create_future()
+    def resolve(val):
+      if not fut.done():
+        fut.set_result(val)
+    def wake(val):
+      try:
+        loop.call_soon_threadsafe(resolve, val)
+      except RuntimeError:
+        pass
+    waiter = self._add_waiter(field, value, wake)
+    try:
+      return await asyncio.wait_for(fut, timeout)
+    except asyncio.TimeoutError:
+      raise StateTimeoutError("Timed out waiting for '%s'" % field)
+    finally:
+      self._remove_waiter(waiter)
+
   @classmethod
-  def discover(cls, version = 2):
+  def discover(cls, version = 3):
     resp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     resp_sock.bind(('', cls.DISCOVER_RESP_PORT))
     resp_sock.settimeout(0.5)
@@ -204,8 +1118,10 @@ class Emotiva(object):
     devices = []
     while True:
       try:
-        _resp_data, (ip, port) = resp_sock.recvfrom(4096)
+        _resp_data, (ip, port) = resp_sock.recvfrom(cls.PROBE_DATAGRAM)
         resp = cls._parse_response(_resp_data)
+        if resp is None:
+          continue
         devices.append((ip, resp))
       except socket.timeout:
         break
@@ -213,14 +1129,19 @@ class Emotiva(object):
 
   @classmethod
   def _parse_response(cls, data):
+    """
+    Returns the root element of the packet, or None if it can't be parsed.
+    """
     _LOGGER.debug(data)
+    xml = get_xml_backend()
     try: 
-      parser = etree.XMLParser(ns_clean=True, recover = True)
-      root = etree.XML(data, parser)
-    except etree.ParseError:
+      root = xml.fromstring(data)
+    except xml.ParseError:
+      root = None
+    if root is None:
+      # lxml's recover mode returns None for packets it can't salvage at all
       _LOGGER.error("Malformed XML")
       _LOGGER.error(data)
-      root = ""
     return root
 
   @classmethod
@@ -234,20 +1155,21 @@ class Emotiva(object):
     {'protocol': "3.0"}
     """
     output = cls.XML_HEADER
-    builder = etree.TreeBuilder()
+    xml = get_xml_backend()
+    builder = xml.TreeBuilder()
     builder.start(pkt_type,pkt_attrs)
     for cmd, params in req:
       builder.start(cmd, params)
       builder.end(cmd)
     builder.end(pkt_type)
     pkt = builder.close()
-    return output + etree.tostring(pkt)
+    return output + xml.tostring(pkt)
 
   def update(self):
     msg = self.format_request('emotivaUpdate',
-                              [(ev, {}) for ev in self.NOTIFY_EVENTS],
-                              {'protocol':"3.0"} if self._proto_ver == 3 else {})
-    self._send_request(msg, ack=True)
+                              [(ev, {}) for ev in self._supported(self.NOTIFY_EVENTS)],
+                              self._protocol_attrs())
+    self._learn_capabilities(self._send_request(msg, ack=True))
 
   @property
   def name(self):
@@ -261,37 +1183,151 @@ class Emotiva(object):
   def address(self):
     return self._ip
 
+  @property
+  def zones(self):
+    return self._zones
+
+  @property
+  def main(self):
+    return self._zones[0]
+
+  @property
+  def zone2(self):
+    return self._zones[1]
+
   @property
   def power(self):
-    if self._current_state['power'] == 'On':
-      return True
-    return False
+    return self._state.power
 
   @power.setter
   def power(self, onoff):
+    self._set_power(onoff)
+
+  def _set_power(self, onoff, zone=''):
     cmd = {True: 'power_on', False: 'power_off'}[onoff]
-    msg = self.format_request('emotivaControl', [(cmd, {'value': '0'})])
+    msg = self.format_request('emotivaControl', [(zone + cmd, {'value': '0'})])
     self._send_request(msg)
 
   @property
   def volume(self):
-    if self._current_state['volume'] != None:
-      return float(self._current_state['volume'].replace(" ", ""))
-    return None
+    return self._state.volume
 
   @volume.setter
   def volume(self, value):
-    msg = self.format_request('emotivaControl', [('set_volume', {'value': str(value)})])
+    self.cancel_volume_ramp()
+    self._set_volume(value)
+
+  def _set_volume(self, value, zone=''):
+    msg = self.format_request('emotivaControl', [(zone + 'set_volume', {'value': str(value)})])
     self._send_request(msg)
 
-  def _volume_step(self, incr):
+  def ramp_volume(self, target, rate=VOLUME_RAMP_RATE):
+    """
+    Moves the volume to target (in dB) at rate dB per second by sending
+    intermediate set_volume commands from a background thread. A new ramp,
+    an explicit volume change or cancel_volume_ramp() stops a running ramp.
+    A ramp that supersedes a running one continues from the last level that
+    one sent rather than from the last notified volume. If the current volume
+    is unknown or rate is not positive, the target is set directly.
+    """
+    target = min(max(float(target), self.MIN_VOLUME), self.MAX_VOLUME)
+    cancel = threading.Event()
+    start = None
+    with self._ramp_lock:
+      if self._ramp_cancel is not None:
+        self._ramp_cancel.set()
+        start = self._ramp_level
+      self._ramp_cancel = cancel
+    if start is None:
+      start = self.volume
+    if start == target:
+      self._end_ramp(cancel)
+      return
+    if start is None or not rate or rate <= 0:
+      self._ramp_step(cancel, target)
+      self._end_ramp(cancel)
+      return
+    thread = threading.Thread(target=self._ramp_volume,
+                              args=(start, target, float(rate), cancel))
+    thread.daemon = True
+    thread.start()
+
+  def cancel_volume_ramp(self):
+    with self._ramp_lock:
+      if self._ramp_cancel is not None:
+        self._ramp_cancel.set()
+        self._ramp_cancel = None
+        self._ramp_level = None
+
+  def _end_ramp(self, cancel):
+    with self._ramp_lock:
+      if self._ramp_cancel is cancel:
+        self._ramp_cancel = None
+        self._ramp_level = None
+
+  def _ramp_volume(self, start, target, rate, cancel):
+    distance = abs(target - start)
+    steps = max(1, int(math.ceil(distance / self.VOLUME_RAMP_STEP)))
+    interval = distance / steps / rate
+    for i in range(1, steps + 1):
+      if i == steps:
+        level = target
+      else:
+        # the processor works in 0.5 dB increments
+        level = round((start + (target - start) * i / steps) * 2) / 2
+      if not self._ramp_step(cancel, level):
+        return
+      if i < steps and cancel.wait(interval):
+        return
+    self._end_ramp(cancel)
+
+  def _ramp_step(self, cancel, level):
+    # Sending under the lock guarantees that no step of a superseded ramp
+    # goes out after the command that cancelled it.
+    with self._ramp_lock:
+      if cancel.is_set():
+        return False
+      self._set_volume(level)
+      self._ramp_level = level
+    return True
+
+  def _volume_step(self, incr, zone=''):
+    if zone:
+      msg = self.format_request('emotivaControl', [(zone + 'volume', {'value': str(incr)})])
+      self._send_request(msg)
+      return
+    self.cancel_volume_ramp()
     # The XMC-1 with firmware version <= 3.1a will not change the volume unless
-    # the volume overlay is up. So, we first send a noop command for volume step
-    # with value 0, and then send the real step.
-    noop = self.format_request('emotivaControl', [('volume', {'value': '0'})])
+    # the volume overlay is up. So, unless the device is known not to need it,
+    # we first send a noop command for volume step with value 0.
+    noop = self.capabilities.volume_noop
+    if noop is None and self._probe_volume_noop(incr):
+      return
+    if noop is not False:
+      msg = self.format_request('emotivaControl', [('volume', {'value': '0'})])
+      self._send_request(msg)
+    msg = self.format_request('emotivaControl', [('volume', {'value': str(incr)})])
+    self._send_request(msg)
+
+  def _probe_volume_noop(self, incr):
+    # Sends the step without the noop and watches for the volume notify.
+    # Returns True if the step took effect, i.e. the noop isn't needed.
+    # Otherwise the noop is recorded as needed and the caller sends both.
+    state = self._state
+    before = state.volume
+    if (not state.power or state.mute or before is None or
+        not self.MIN_VOLUME <= before + incr <= self.MAX_VOLUME):
+      # a step can't be observed right now, probe on a later one
+      return False
     msg = self.format_request('emotivaControl', [('volume', {'value': str(incr)})])
-    self._send_request(noop)
     self._send_request(msg)
+    try:
+      self.wait_for('volume', lambda v: v != before, self.VOLUME_PROBE_TIMEOUT)
+    except StateTimeoutError:
+      self._update_capabilities(lambda caps: caps._replace(volume_noop=True))
+      return False
+    self._update_capabilities(lambda caps: caps._replace(volume_noop=False))
+    return True
 
   def volume_up(self):
     self._volume_step(1)
@@ -301,49 +1337,56 @@ class Emotiva(object):
 
   @property
   def mute(self):
-    return self._muted
+    return self._state.mute
 
   @mute.setter
   def mute(self, enable):
+    self._set_mute(enable)
+
+  def _set_mute(self, enable, zone=''):
     mute_cmd = {True: 'mute_on', False: 'mute_off'}[enable]
-    msg = self.format_request('emotivaControl', [(mute_cmd, {'value': '0'})])
+    msg = self.format_request('emotivaControl', [(zone + mute_cmd, {'value': '0'})])
     self._send_request(msg)
 
   @property
   def sources(self):
-    return tuple(self._sources.keys())
+    return self._state.sources
 
   @property
   def source(self):
-    return self._current_state['source']
+    return self._state.source
 
   @source.setter
   def source(self, val):
-    if val not in self._sources:
+    self._set_source(val)
+
+  def _set_source(self, val, zone=''):
+    sources = self._state.source_map
+    if val not in sources:
       raise InvalidSourceError('Source "%s" is not a valid input' % val)
-    elif self._sources[val] is None:
+    elif sources[val] is None:
       raise InvalidSourceError('Source "%s" has bad value (%s)' % (
-          val, self._sources[val]))
+          val, sources[val]))
     msg = self.format_request('emotivaControl',
-        [('source_%d' % self._sources[val], {'value': '0'})])
+        [(self.SOURCE_COMMANDS[zone] % sources[val], {'value': '0'})])
     self._send_request(msg)
 
   
   @property
   def modes(self):
-    #we return only the modes that are active
-    return tuple(dict(filter(lambda elem: elem[1][2] == True, self._modes.items())).keys())
+    return self._state.modes
   
   @property
   def mode(self):
-    return self._current_state['mode']
+    return self._state.mode
 
   @mode.setter
   def mode(self, val):
-    if val not in self._modes:
+    modes = self._state.mode_map
+    if val not in modes:
       raise InvalidModeError('Mode "%s" does not exist' % val)
-    elif self._modes[val][0] is None:
+    elif modes[val][0] is None:
       raise InvalidModeError('Mode "%s" has bad value (%s)' % (
-          val, self._modes[val][0]))
-    msg = self.format_request('emotivaControl',[(self._modes[val][0],  {'value': '0'})])
+          val, modes[val][0]))
+    msg = self.format_request('emotivaControl',[(modes[val][0],  {'value': '0'})])
     self._send_request(msg)
\ No newline at end of file